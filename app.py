@@ -1,10 +1,12 @@
 #!/usr/bin/env python3
 from __future__ import annotations
-from flask import Flask, request, redirect, url_for, render_template_string, send_from_directory, flash
+from flask import Flask, Request, request, redirect, url_for, render_template, send_from_directory, flash
 from pathlib import Path
-from typing import List, Tuple
+from typing import Dict, List, NamedTuple, Optional, Tuple
 from datetime import datetime
-import subprocess, shutil, json, os
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import subprocess, shutil, json, os, re, functools, hashlib, threading, collections, multiprocessing, tempfile
 import numpy as np
 
 # Compatibility shims for deprecated numpy aliases used by some libs
@@ -13,18 +15,51 @@ if not hasattr(np, "complex"):
 if not hasattr(np, "float"):
     np.float = np.float64  # type: ignore[attr-defined]
 
-import librosa
-import matplotlib
-matplotlib.use("Agg")
-import matplotlib.pyplot as plt
+# librosa and matplotlib are imported inside the functions that use them,
+# so the web process and /health don't load them until the first analysis
 
+# onset analysis runs at 44.1 kHz with 2048/512 (46 ms window, 11.6 ms hop); at 22.05 kHz the onset envelope
+# loses the 11-22 kHz band and picks extra onsets (58 instead of 48 on jobs/20250817_081907_759302/beats.mp3)
+ANALYSIS_SR = 44100  # rendering always uses the original audio file
+N_FFT = 2048
 FRAME_HOP = 512
+SEGMENT_THREADS = 2  # per-ffmpeg thread cap while segments encode in parallel
+WAVEFORM_BINS = 4000  # plotted points; each bin keeps its min/max so the envelope survives
+GRAPH_MAX_FRAMES = 600  # single-graph renders hold pending segments in RAM; longer timelines encode per segment
+FFCONCAT_OPTION_MIN = 5  # FFmpeg major version whose concat demuxer accepts "option"; older builds render images per segment
+ASPECT_MAP = {
+    "16:9": (1280, 720),
+    "1:1": (720, 720),
+    "9:16": (720, 1280),
+    "4:3": (960, 720),
+}
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("FLASK_SECRET", "dev-secret")
 BASE_DIR = Path(__file__).parent.resolve()
 JOBS_DIR = BASE_DIR / "jobs"
 JOBS_DIR.mkdir(exist_ok=True)
+# decoded audio + onset envelope keyed by audio content hash; kept out of JOBS_DIR, which /jobs/ serves
+ANALYSIS_CACHE_DIR = BASE_DIR / ".cache"
+ANALYSIS_CACHE_MAX_BYTES = int(os.environ.get("ANALYSIS_CACHE_MB", "1024")) << 20  # least recently used entries go first
+UPLOAD_SPOOL_MIN = 500 * 1024  # parts bigger than this are spooled to disk, same cutoff as werkzeug
+UPLOAD_SPOOL_DIR = BASE_DIR / ".uploads"  # outside JOBS_DIR so in-flight uploads aren't served, same filesystem for linking
+
+
+class UploadRequest(Request):
+    """Spools large file parts to a named temp file in UPLOAD_SPOOL_DIR so save_upload can link it into place."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if total_content_length is None or total_content_length > UPLOAD_SPOOL_MIN:
+            UPLOAD_SPOOL_DIR.mkdir(exist_ok=True)
+            return tempfile.NamedTemporaryFile("wb+", dir=UPLOAD_SPOOL_DIR)
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+
+app.request_class = UploadRequest
+# behind nginx/Apache, hand file bodies to the front server instead of streaming them through Python
+app.use_x_sendfile = os.environ.get("USE_X_SENDFILE") == "1"
+IMMUTABLE_JOB_FILES = {"waveform.png"}  # written once per job; safe for browsers to keep
 
 INDEX_HTML = """
 <!doctype html>
@@ -177,6 +212,31 @@ ANALYSIS_RESULT_HTML = """
 </html>
 """
 
+ANALYSIS_PENDING_HTML = """
+<!doctype html>
+<html lang=\"en\">
+<head>
+    <meta charset=\"utf-8\">
+    <meta name=\"viewport\" content=\"width=device-width,initial-scale=1\">
+    <meta http-equiv=\"refresh\" content=\"1\">
+    <title>Flash-cut - Analyzing</title>
+    <link rel=\"stylesheet\" href=\"https://cdn.jsdelivr.net/npm/@picocss/pico@2/css/pico.min.css\">
+    <style>
+        body { padding-block: 1.5rem; background: #f8fafc; }
+        .centered { max-width: 480px; margin: 2rem auto; background: #fff; border-radius: 16px; box-shadow: 0 2px 16px #0001; padding: 2rem; text-align: center; }
+        .logo { display: block; margin: 0 auto 1.5rem; width: 64px; }
+    </style>
+</head>
+<body>
+    <main class=\"centered\">
+        <img src=\"https://cdn.jsdelivr.net/gh/tabler/tabler-icons/icons/chart-line.svg\" class=\"logo\" alt=\"logo\">
+        <h2>Analyzing audio...</h2>
+        <p aria-busy=\"true\">Detecting beats and building the cut list. This page refreshes automatically.</p>
+    </main>
+</body>
+</html>
+"""
+
 UPLOAD_VISUAL_HTML = """
 <!doctype html>
 <html lang=\"en\">
@@ -365,7 +425,7 @@ RENDER_OPTIONS_HTML = """
         <div class=\"media-preview\">
             {% for file in media_files %}
                 {% if file.type == 'image' %}
-                    <img src=\"{{ url_for('download', job_id=job_id, filename=file.filename) }}\" alt=\"Image\" class=\"media-thumbnail\">
+                    <img src=\"{{ url_for('download', job_id=job_id, filename=file.thumb or file.filename) }}\" alt=\"Image\" class=\"media-thumbnail\">
                 {% else %}
                     <div class=\"media-thumbnail\" style=\"display: flex; justify-content: center; align-items: center; background: #000;\">
                         <span style=\"font-size: 24px; color: #fff;\">▶️</span>
@@ -540,10 +600,53 @@ RESULT_HTML = """
 """
 app.config["MAX_CONTENT_LENGTH"] = 500 * 1024 * 1024  # 500 MB cap
 
+# parsed once at import; render_template_string would re-parse the source on every request
+INDEX_TPL = app.jinja_env.from_string(INDEX_HTML)
+ANALYSIS_RESULT_TPL = app.jinja_env.from_string(ANALYSIS_RESULT_HTML)
+ANALYSIS_PENDING_TPL = app.jinja_env.from_string(ANALYSIS_PENDING_HTML)
+UPLOAD_VISUAL_TPL = app.jinja_env.from_string(UPLOAD_VISUAL_HTML)
+RENDER_OPTIONS_TPL = app.jinja_env.from_string(RENDER_OPTIONS_HTML)
+RESULT_TPL = app.jinja_env.from_string(RESULT_HTML)
+
+
 # ---------------- helpers ----------------
+def save_upload(f, dst: Path) -> None:
+    """FileStorage.save, but a part spooled by UploadRequest is hard-linked instead of copied a second time."""
+    name = getattr(f.stream, "name", None)
+    if isinstance(name, str):
+        f.stream.flush()
+        try:
+            os.link(name, dst)  # the spool file itself is unlinked when the request closes
+        except OSError:
+            pass  # destination exists, other filesystem, no hard links: copy as before
+        else:
+            # after the link dst *is* the spool file, so never fall through to f.save() from here
+            os.chmod(dst, 0o644)  # mkstemp creates 0600; keep what a plain save would give
+            return
+    f.save(str(dst), buffer_size=1 << 20)  # werkzeug copies in 16 KB reads by default
+
+def make_thumbnail(src: Path, height: int = 200) -> Optional[str]:
+    """Small WebP for the preview grid (100px tall, 2x for HiDPI); returns its job-relative name or None."""
+    from PIL import Image
+    rel = f"_thumbs/{src.name}.webp"
+    try:
+        dst = src.parent / rel
+        dst.parent.mkdir(exist_ok=True)
+        with Image.open(src) as im:
+            im.thumbnail((height * 4, height))
+            im.save(dst, "WEBP", quality=75, method=6)
+        return rel
+    except Exception as e:
+        print(f"Thumbnail failed for {src.name}: {e}")
+        return None
+
+
+# render commands only report errors; progress lines and banners would just fill the stderr pipe
+FFMPEG_QUIET = ("-hide_banner", "-loglevel", "error", "-nostats")
 
+@functools.lru_cache(maxsize=1)
 def _ffmpeg_bin() -> str:
-    # Try multiple common locations for FFmpeg
+    # Try multiple common locations for FFmpeg (resolved once per process)
     ffmpeg_paths = [
         os.environ.get("FFMPEG"),
         shutil.which("ffmpeg"),
@@ -561,8 +664,21 @@ def _ffmpeg_bin() -> str:
     # Default fallback
     return "ffmpeg"
 
+@functools.lru_cache(maxsize=1)
+def _ffmpeg_major() -> int:
+    """Major version of _ffmpeg_bin(), 0 if unknown; git snapshots ("N-12345-g...") count as newer than any release."""
+    try:
+        out = subprocess.run([_ffmpeg_bin(), "-version"], capture_output=True, text=True).stdout
+    except Exception:
+        return 0
+    m = re.match(r"ffmpeg version n?(\d+)\.", out)
+    if m:
+        return int(m.group(1))
+    return 1 << 16 if out.startswith("ffmpeg version N-") else 0
+
+@functools.lru_cache(maxsize=1)
 def _ffprobe_bin() -> str:
-    # Try multiple common locations for FFprobe
+    # Try multiple common locations for FFprobe (resolved once per process)
     ffprobe_paths = [
         os.environ.get("FFPROBE"),
         shutil.which("ffprobe"),
@@ -580,124 +696,369 @@ def _ffprobe_bin() -> str:
     # Default fallback
     return "ffprobe"
 
-def extract_audio_from_video(video_path, output_audio_path):
-    """Extract audio track from a video file using FFmpeg."""
+AUDIO_COPY_EXT = {"aac": ".m4a", "mp3": ".mp3"}  # track codecs kept as-is when extracting from a video
+
+def extract_audio_from_video(video_path, output_stem: Path, sr: int):
+    """Save the video's audio track and decode it for analysis in the same FFmpeg pass.
+
+    AAC/MP3 tracks are remuxed untouched, anything else is encoded to MP3.
+    Returns (saved audio path, mono float32 samples at sr), or None on failure.
+    """
     ffmpeg = _ffmpeg_bin()
+    try:
+        mtime = os.path.getmtime(video_path)
+    except OSError:
+        mtime = 0.0
+    codec = _probe_audio_codec_cached(str(video_path), mtime)
+    if codec in AUDIO_COPY_EXT:
+        output_audio_path = output_stem.with_name(output_stem.name + AUDIO_COPY_EXT[codec])
+        audio_args = ["-c:a", "copy"]
+    else:
+        output_audio_path = output_stem.with_name(output_stem.name + ".mp3")
+        audio_args = ["-acodec", "libmp3lame", "-q:a", "2"]
     cmd = [
-        ffmpeg,
+        ffmpeg, "-y", *FFMPEG_QUIET,
         "-i", str(video_path),
-        "-vn",                 # No video
-        "-acodec", "libmp3lame",  # MP3 codec
-        "-q:a", "2",           # Quality (lower is better)
-        "-y",                  # Overwrite output
-        str(output_audio_path)
+        "-map", "0:a:0", "-vn", *audio_args, str(output_audio_path),
+        # second output: the same decoded track as raw PCM for the analysis
+        "-map", "0:a:0", "-vn", "-f", "f32le", "-ac", "1", "-ar", str(sr), "-",
     ]
-    
+
     try:
         print(f"Extracting audio from video: {video_path}")
-        run_cmd(cmd)
-        return True
+        print(f"Running command: {' '.join(cmd)}")
+        proc = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return output_audio_path, np.frombuffer(proc.stdout, dtype=np.float32)
     except Exception as e:
         print(f"Failed to extract audio: {e}")
+        return None
+
+def _decode_pcm_ffmpeg(audio_path, sr: int) -> np.ndarray:
+    """Decode any file ffmpeg can read to mono float32 PCM at sr, straight from its stdout."""
+    proc = subprocess.run([
+        _ffmpeg_bin(), "-v", "error", "-i", str(audio_path),
+        "-vn", "-f", "f32le", "-ac", "1", "-ar", str(sr), "-",
+    ], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return np.frombuffer(proc.stdout, dtype=np.float32)
+
+class H264Encoder(NamedTuple):
+    name: str
+    output_args: Tuple[str, ...]
+    input_args: Tuple[str, ...] = ()
+    upload_filter: str = ""  # appended to -vf for encoders that need frames in GPU memory
+    max_sessions: int = 0  # concurrent encodes the hardware allows, 0 = unlimited
+
+
+# best first; libx264 is the fallback that always works
+H264_ENCODERS = [
+    H264Encoder("h264_nvenc", ("-pix_fmt", "yuv420p", "-c:v", "h264_nvenc", "-preset", "p4", "-cq", "20"), max_sessions=2),
+    H264Encoder(
+        "h264_vaapi", ("-c:v", "h264_vaapi", "-qp", "20"),
+        input_args=("-vaapi_device", os.environ.get("VAAPI_DEVICE", "/dev/dri/renderD128")),
+        upload_filter="format=nv12,hwupload", max_sessions=2,
+    ),
+    H264Encoder("h264_qsv", ("-pix_fmt", "nv12", "-c:v", "h264_qsv", "-preset", "veryfast", "-global_quality", "20"), max_sessions=2),
+    H264Encoder("h264_videotoolbox", ("-pix_fmt", "yuv420p", "-c:v", "h264_videotoolbox", "-q:v", "65"), max_sessions=2),
+    H264Encoder("libx264", ("-pix_fmt", "yuv420p", "-c:v", "libx264", "-preset", "veryfast", "-crf", "20")),
+]
+
+def _encoder_works(ffmpeg: str, enc: H264Encoder) -> bool:
+    # builds list hardware encoders they have no device for, so try a one-frame encode
+    vf = ",".join(f for f in ("format=yuv420p", enc.upload_filter) if f)
+    cmd = [
+        ffmpeg, "-hide_banner", "-loglevel", "error", *enc.input_args,
+        "-f", "lavfi", "-i", "color=black:s=256x256:r=25", "-frames:v", "1",
+        "-vf", vf, *enc.output_args, "-f", "null", "-",
+    ]
+    try:
+        return subprocess.run(cmd, capture_output=True, timeout=20).returncode == 0
+    except Exception:
         return False
 
+@functools.lru_cache(maxsize=1)
+def _h264_encoder() -> H264Encoder:
+    """Fastest usable H.264 encoder of this ffmpeg build (H264_ENCODER env var forces one)."""
+    fallback = H264_ENCODERS[-1]
+    forced = os.environ.get("H264_ENCODER")
+    if forced:
+        return next((e for e in H264_ENCODERS if e.name == forced), fallback)
+    ffmpeg = _ffmpeg_bin()
+    try:
+        listed = subprocess.run([ffmpeg, "-hide_banner", "-encoders"], capture_output=True, text=True, timeout=20).stdout
+    except Exception:
+        return fallback
+    for enc in H264_ENCODERS[:-1]:
+        if f" {enc.name} " in listed and _encoder_works(ffmpeg, enc):
+            print(f"Using hardware encoder: {enc.name}")
+            return enc
+    return fallback
+
+def _fit_scale(target_w: int, target_h: int) -> str:
+    """Letterbox into the target frame."""
+    return f"scale={target_w}:{target_h}:force_original_aspect_ratio=decrease,pad={target_w}:{target_h}:(ow-iw)/2:(oh-ih)/2:black"
+
+def _fit_vf(fps: float, target_w: int, target_h: int) -> str:
+    """Resample to the output rate and letterbox into the target frame."""
+    return f"fps={int(fps)},{_fit_scale(target_w, target_h)}"
+
+def _encode_args(vf: str = "") -> List[str]:
+    """-vf and codec flags for an H.264 re-encode with the selected encoder."""
+    enc = _h264_encoder()
+    chain = ",".join(f for f in (vf, enc.upload_filter) if f)
+    return (["-vf", chain] if chain else []) + list(enc.output_args)
+
+def _cpu_count() -> int:
+    """CPUs this process may run on; os.cpu_count() reports the whole host even when pinned to a few."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # not available on macOS/Windows
+        return os.cpu_count() or 1
+
+def _segment_workers(n: int) -> int:
+    """Number of concurrent ffmpeg segment encodes for a job with n segments."""
+    # each encode runs SEGMENT_THREADS threads, so this many keeps every core busy without oversubscribing
+    workers = min(max(1, _cpu_count() // SEGMENT_THREADS), n)
+    sessions = _h264_encoder().max_sessions
+    return max(1, min(workers, sessions) if sessions else workers)
+
 # Helper function to run shell commands
 
 def run_cmd(cmd, cwd=None):
-    """Run a command using subprocess.run and raise an error if it fails."""
-    import subprocess
+    """Run a command to completion; a failure raises CalledProcessError carrying the tail of its stderr."""
+    wait_cmd(run_cmd_async(cmd, cwd=cwd))
+
+def run_cmd_async(cmd, cwd=None) -> subprocess.Popen:
+    """Start a command without waiting; its stderr is only kept for the failure report."""
     print(f"Running command: {' '.join(cmd)}")
-    subprocess.run(cmd, check=True, cwd=cwd)
+    proc = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    # drain in the background so a chatty ffmpeg never stalls on a full pipe
+    proc.stderr_tail = collections.deque(maxlen=40)
+    proc.drainer = threading.Thread(target=proc.stderr_tail.extend, args=(proc.stderr,), daemon=True)
+    proc.drainer.start()
+    return proc
+
+def wait_cmd(proc: subprocess.Popen) -> None:
+    rc = proc.wait()
+    proc.drainer.join()
+    proc.stderr.close()
+    if rc:
+        err = b"".join(proc.stderr_tail)
+        print(err.decode(errors="replace"))
+        raise subprocess.CalledProcessError(rc, proc.args, stderr=err)
+
+def run_cmds(cmds: List[List[str]], workers: int) -> None:
+    """Run independent commands with at most `workers` alive at once; raises on the first failure."""
+    running = collections.deque()
+    try:
+        for cmd in cmds:
+            if len(running) >= workers:
+                wait_cmd(running.popleft())
+            running.append(run_cmd_async(cmd))
+        while running:
+            wait_cmd(running.popleft())
+    finally:
+        for proc in running:
+            proc.kill()
+            proc.wait()
 
 # ---------------- signal processing ----------------
 
-def quantize_to_fps(times: List[float], fps: float) -> List[float]:
-    return [round(t * fps) / fps for t in times]
+def quantize_to_fps(times, fps: float) -> np.ndarray:
+    return np.round(np.asarray(times, dtype=np.float64) * fps) / fps
 
-def confidence_from_envelope(times, env, sr, hop):
+def confidence_from_envelope(times, env, sr, hop) -> np.ndarray:
     if len(times) == 0:
-        return []
-    frames = librosa.time_to_frames(times, sr=sr, hop_length=hop)
-    frames = np.clip(frames, 0, len(env) - 1)
+        return np.empty(0)
+    # same as librosa.time_to_frames (samples floored, then floor-divided by hop) without the dispatch
+    frames = np.clip((np.asarray(times, dtype=np.float64) * sr).astype(np.intp) // hop, 0, len(env) - 1)
     vals = env[frames]
     scale = np.quantile(env, 0.98) or (env.max() or 1.0)
-    return np.clip(vals / (scale if scale > 0 else 1.0), 0.0, 1.0).tolist()
+    return np.clip(vals / (scale if scale > 0 else 1.0), 0.0, 1.0)
+
+@functools.lru_cache(maxsize=1)
+def _median_rows_kernel():
+    """Numba running median along the last axis; same output as scipy's median_filter with mode='reflect'.
+
+    Except for 2-sample rows: there scipy's reflect padding reads one value from outside the row, so its
+    window is off by one sample, while this returns the row unchanged (a 2-frame STFT in practice).
+    """
+    import numba
+
+    @numba.njit(cache=True, parallel=True, nogil=True)
+    def median_rows(x, k):
+        h = k // 2
+        n_rows, n = x.shape
+        out = np.empty_like(x)
+        for r in numba.prange(n_rows):
+            # reflect-padded row (d c b a | a b c d | d c b a), repeated for rows shorter than h
+            pad = np.empty(n + 2 * h, x.dtype)
+            for i in range(n + 2 * h):
+                j = i - h
+                while j < 0 or j >= n:
+                    j = -j - 1 if j < 0 else 2 * n - j - 1
+                pad[i] = x[r, j]
+            # sorted window: each step swaps the outgoing sample for the incoming one in place
+            win = np.sort(pad[:k])
+            out[r, 0] = win[h]
+            for i in range(1, n):
+                old, new = pad[i - 1], pad[i + k - 1]
+                p = np.searchsorted(win, old)
+                if new > old:
+                    while p + 1 < k and win[p + 1] < new:
+                        win[p] = win[p + 1]
+                        p += 1
+                else:
+                    while p > 0 and win[p - 1] > new:
+                        win[p] = win[p - 1]
+                        p -= 1
+                win[p] = new
+                out[r, i] = win[h]
+        return out
+
+    return median_rows
+
+def _percussive(y: np.ndarray, hop: int = FRAME_HOP, kernel: int = 31) -> np.ndarray:
+    """librosa.effects.hpss(y)[1] with the two median filters, ~85% of its time, done by the numba kernel."""
+    import librosa
+    median_rows = _median_rows_kernel()
+    # one batched STFT; the mask scales it directly (mag * phase == S), so no phase array is built
+    S = librosa.stft(y, n_fft=N_FFT, hop_length=hop)
+    mag = np.abs(S)
+    harm = median_rows(mag, kernel)
+    perc = median_rows(np.ascontiguousarray(mag.T), kernel).T
+    S *= librosa.util.softmask(perc, harm, power=2.0, split_zeros=True)
+    return librosa.istft(S, n_fft=N_FFT, hop_length=hop, length=len(y), dtype=y.dtype)
+
+def _compute_env(y: np.ndarray, sr: int, hop: int = FRAME_HOP) -> np.ndarray:
+    """Percussive spectral-flux onset envelope (HPSS + onset strength), one value per hop."""
+    import librosa
+    import scipy.fft
+    # librosa's STFTs go through scipy.fft; let pocketfft split each batched transform across this worker's cores
+    with scipy.fft.set_workers(int(os.environ.get("NUMBA_NUM_THREADS", -1))):
+        y_perc = _percussive(y, hop=hop)
+        return librosa.onset.onset_strength(y=y_perc, sr=sr, n_fft=N_FFT, hop_length=hop, aggregate=np.median)
 
-def detect_onsets_flux(y: np.ndarray, sr: int, hop: int = FRAME_HOP, threshold: float = 0.30) -> List[dict]:
-    _, y_perc = librosa.effects.hpss(y)
-    env = librosa.onset.onset_strength(y=y_perc, sr=sr, hop_length=hop, aggregate=np.median)
+def _pick_onsets(env: np.ndarray, sr: int, hop: int = FRAME_HOP, threshold: float = 0.30) -> List[dict]:
+    import librosa
     onset_times = librosa.onset.onset_detect(
         onset_envelope=env, sr=sr, hop_length=hop, units="time",
         backtrack=False, pre_max=3, post_max=3, pre_avg=3, post_avg=3, delta=0.0
     )
     conf = confidence_from_envelope(onset_times, env, sr, hop)
-    keep = [i for i, c in enumerate(conf) if c >= threshold]
-    return [{"time": float(onset_times[i]), "confidence": float(conf[i])} for i in keep]
+    mask = conf >= threshold
+    return [{"time": t, "confidence": c} for t, c in zip(onset_times[mask].tolist(), conf[mask].tolist())]
 
-def detect_beats(audio_path: str, threshold: float):
-    y, sr = librosa.load(audio_path, sr=None, mono=True)
-    duration = float(librosa.get_duration(y=y, sr=sr))
-    events = detect_onsets_flux(y, sr, hop=FRAME_HOP, threshold=threshold)
-    return events, duration, sr, y
+def _stream_digest(f) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    for chunk in iter(lambda: f.read(1 << 20), b""):
+        h.update(chunk)
+    return h.hexdigest()
+
+def _load_audio(audio_path: str):
+    """Decode mono float32 audio at ANALYSIS_SR with libsndfile when it can read the file."""
+    import librosa
+    try:
+        # a file object keeps librosa on soundfile instead of its audioread fallback
+        with open(audio_path, "rb") as f:
+            return librosa.load(f, sr=ANALYSIS_SR, mono=True, dtype=np.float32)
+    except Exception:
+        pass  # e.g. M4A/AAC, which libsndfile can't read
+    # ffmpeg decodes and resamples in one pass instead of audioread's per-block Python loop
+    return _decode_pcm_ffmpeg(audio_path, ANALYSIS_SR), ANALYSIS_SR
+
+def _write_json(path: Path, data) -> None:
+    """Write compact JSON atomically, like _write_npz."""
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp.write_text(json.dumps(data, separators=(",", ":")), encoding="utf-8")
+    os.replace(tmp, path)
+
+def _write_npz(path: Path, **arrays) -> None:
+    """Write an .npz atomically so concurrent readers never see a partial file."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, path)
+
+def _prune_analysis_cache() -> None:
+    """Delete the least recently used analysis entries until the cache fits in ANALYSIS_CACHE_MAX_BYTES."""
+    entries = []
+    for p in ANALYSIS_CACHE_DIR.glob("*.npz"):
+        try:
+            st = p.stat()
+        except OSError:
+            continue  # removed by another worker meanwhile
+        entries.append((st.st_mtime, st.st_size, p))
+    total = sum(size for _, size, _ in entries)
+    for _, size, p in sorted(entries):
+        if total <= ANALYSIS_CACHE_MAX_BYTES:
+            break
+        try:
+            p.unlink()
+        except OSError:
+            pass
+        total -= size
+
+def detect_beats(audio_path: str, threshold: float, samples=None):
+    # threshold/fps/max_gap are applied after the envelope, so they don't take part in the key
+    with open(audio_path, "rb") as f:
+        digest = _stream_digest(f)
+    cache = ANALYSIS_CACHE_DIR / f"{digest}_{ANALYSIS_SR}_{N_FFT}_{FRAME_HOP}.npz"
+    try:
+        with np.load(cache) as npz:
+            y, env, sr = npz["y"], npz["env"], int(npz["sr"])
+        try:
+            os.utime(cache)  # mtime doubles as last use for _prune_analysis_cache
+        except OSError:
+            pass
+    except Exception:
+        # samples: already decoded at ANALYSIS_SR (video uploads)
+        y, sr = (samples, ANALYSIS_SR) if samples is not None else _load_audio(audio_path)
+        env = _compute_env(y, sr, hop=FRAME_HOP)
+        try:
+            _write_npz(cache, y=y, env=env, sr=sr)
+            _prune_analysis_cache()
+        except OSError as e:
+            print(f"Failed to cache analysis: {e}")
+    duration = float(len(y)) / sr
+    events = _pick_onsets(env, sr, hop=FRAME_HOP, threshold=threshold)
+    return events, duration, sr, y, env
 
 # ---------------- timeline building ----------------
 
 def compute_intervals(beats: List[dict], duration: float, fps: float, max_gap: float):
     end = round(duration * fps) / fps
-    if not beats:
-        # chunk whole track into <= max_gap spans
-        splits = [0.0]
-        prev = 0.0
-        while end - prev > max_gap:
-            prev += max_gap
-            splits.append(prev)
-        splits.append(end)
-        starts = [round(s, 3) for s in splits[:-1]]
-        ends = [round(e, 3) for e in splits[1:]]
-        return starts, ends
     beat_times = quantize_to_fps(sorted(float(b["time"]) for b in beats), fps)
-    splits = [0.0]
-    prev = 0.0
-    first = beat_times[0]
-    while first - prev > max_gap:
-        prev += max_gap
-        splits.append(prev)
-    splits.append(first)
-    for i in range(1, len(beat_times)):
-        L, R = beat_times[i - 1], beat_times[i]
-        prev = L
-        while R - prev > max_gap:
-            prev += max_gap
-            splits.append(prev)
-        splits.append(R)
-    # ensure tail to full end
-    if end > splits[-1]:
-        prev = splits[-1]
-        while end - prev > max_gap:
-            prev += max_gap
-            splits.append(prev)
-        splits.append(end)
-    starts = [round(s, 3) for s in splits[:-1]]
-    ends = [round(e, 3) for e in splits[1:]]
-    return starts, ends
+    pts = np.concatenate(([0.0], beat_times))
+    # ensure tail to full end (without beats the whole track is one span)
+    if not beats or end > pts[-1]:
+        pts = np.append(pts, end)
+    # chunk every span longer than max_gap into L + k*max_gap splits, k = 1 .. ceil(span/max_gap)-1
+    counts = np.maximum(np.ceil(np.diff(pts) / max_gap - 1e-9).astype(np.intp) - 1, 0)
+    k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + 1
+    fills = np.repeat(pts[:-1], counts) + k * max_gap
+    splits = np.round(np.sort(np.concatenate((pts, fills))), 3)
+    return splits[:-1].tolist(), splits[1:].tolist()
 
 # ---------------- flash window ----------------
 
-def detect_flash_window(y: np.ndarray, sr: int, window: Tuple[float, float], min_gap: float, fps: float, threshold: float) -> List[float]:
+def detect_flash_window(env: np.ndarray, sr: int, window: Tuple[float, float], min_gap: float, fps: float, threshold: float) -> List[float]:
+    # slice the full-track envelope from detect_beats instead of re-running HPSS on the window
     start_s, end_s = max(0.0, min(window)), max(0.0, max(window))
-    i0, i1 = int(start_s * sr), int(end_s * sr)
-    seg = y[i0:i1]
+    f0, f1 = int(start_s * sr / FRAME_HOP), int(end_s * sr / FRAME_HOP)
+    seg = env[f0:f1]
     if seg.size == 0:
         return []
-    events = detect_onsets_flux(seg, sr, hop=FRAME_HOP, threshold=threshold)
-    times = sorted([e["time"] + start_s for e in events])
+    events = _pick_onsets(seg, sr, hop=FRAME_HOP, threshold=threshold)
+    offset = f0 * FRAME_HOP / sr
+    times = sorted([e["time"] + offset for e in events])
     pruned, last = [], -1e9
     g = max(1.0 / fps, float(min_gap))
     for t in times:
         if t - last >= g:
             pruned.append(t)
             last = t
-    return quantize_to_fps(pruned, fps)
+    return quantize_to_fps(pruned, fps).tolist()
 
 # ---------------- rendering (PNG and VIDEO) ----------------
 
@@ -705,43 +1066,82 @@ def render_from_images(pngs: List[str], starts: List[float], ends: List[float],
     ffmpeg = _ffmpeg_bin()
     
     # Set dimensions based on aspect ratio
-    aspect_map = {
-        "16:9": (1280, 720),
-        "1:1": (720, 720),
-        "9:16": (720, 1280),
-        "4:3": (960, 720),
-    }
-    target_w, target_h = aspect_map.get(aspect_ratio, (1280, 720))
+    target_w, target_h = ASPECT_MAP.get(aspect_ratio, (1280, 720))
     
     tmp = Path(out_path).parent / "_preconv"
     tmp.mkdir(parents=True, exist_ok=True)
-    clip_paths = []
-    for i, (s, e) in enumerate(zip(starts, ends), 1):
-        length = max(1.0 / fps, e - s)
-        src = pngs[(i - 1) % len(pngs)]
-        out_i = tmp / f"seg_{i:04d}.mp4"
-        cmd = [
-            ffmpeg, "-y", "-loop", "1", "-t", f"{length:.3f}", "-i", src,
-            "-vf", f"fps={int(fps)},scale={target_w}:{target_h}:force_original_aspect_ratio=decrease,pad={target_w}:{target_h}:(ow-iw)/2:(oh-ih)/2:black",
-            "-pix_fmt", "yuv420p", "-c:v", "libx264", "-preset", "veryfast", "-crf", "20",
-            str(out_i),
-        ]
-        run_cmd(cmd)
-        clip_paths.append(out_i)
-    # concat list with explicit header + LF newlines (Windows friendly)
+    enc = _h264_encoder()
+
+    # fit each image into the frame once; same-size stills let the concat demuxer feed one filter graph
+    fitted = [tmp / f"img_{k:04d}.png" for k in range(min(len(pngs), len(starts)))]
+    run_cmds([
+        [ffmpeg, "-y", *FFMPEG_QUIET, "-i", src, "-vf", f"{_fit_scale(target_w, target_h)},format=rgb24", "-frames:v", "1", str(dst)]
+        for src, dst in zip(pngs, fitted)
+    ], _segment_workers(len(fitted)))
+
+    # whole frames per segment, so timestamps stay exact on the 1/fps grid
+    frames = [max(1, round((e - s) * fps)) for s, e in zip(starts, ends)]
+    if _ffmpeg_major() >= FFCONCAT_OPTION_MIN:
+        entries = [f"file '{fitted[i % len(fitted)].name}'\noption framerate {int(fps)}\nduration {n / int(fps):.6f}" for i, n in enumerate(frames)]
+        # the demuxer ignores the last duration unless the file is listed once more; -frames:v drops the extra frame
+        entries.append(f"file '{fitted[(len(frames) - 1) % len(fitted)].name}'\noption framerate {int(fps)}")
+        input_args, video_args = list(enc.input_args), [*_encode_args(f"fps={int(fps)}"), "-frames:v", str(sum(frames))]
+    else:
+        # without the "option framerate" directive stills come in at 25 fps; encode each distinct
+        # (image, length) clip once instead and join the clips without re-encoding
+        clips: Dict[Tuple[int, int], Path] = {}
+        entries = []
+        for i, n in enumerate(frames):
+            key = (i % len(fitted), n)
+            if key not in clips:
+                clips[key] = tmp / f"seg_{len(clips) + 1:04d}.mp4"
+            entries.append(f"file '{clips[key].name}'")
+        run_cmds([
+            [
+                ffmpeg, "-y", *FFMPEG_QUIET, *enc.input_args, "-loop", "1", "-framerate", str(int(fps)), "-i", str(fitted[k]),
+                *_encode_args(), "-frames:v", str(n), "-threads", str(SEGMENT_THREADS), str(p),
+            ]
+            for (k, n), p in clips.items()
+        ], _segment_workers(len(clips)))
+        input_args, video_args = [], ["-c:v", "copy"]
     list_file = tmp / "list.txt"
-    list_text = "ffconcat version 1.0\n" + "\n".join(f"file '{p.name}'" for p in clip_paths) + "\n"
-    list_file.write_text(list_text, encoding="utf-8", newline="\n")
-    concat_out = tmp / "video.mp4"
+    list_file.write_text("ffconcat version 1.0\n" + "\n".join(entries) + "\n", encoding="utf-8", newline="\n")
     run_cmd([
-        ffmpeg, "-y", "-f", "concat", "-safe", "0", "-i", "list.txt",
-        "-fflags", "+genpts", "-r", str(int(fps)), "-pix_fmt", "yuv420p",
-        "-c:v", "libx264", "-preset", "veryfast", "-crf", "20", "-movflags", "+faststart", str(concat_out),
+        ffmpeg, "-y", *FFMPEG_QUIET, *input_args, "-f", "concat", "-safe", "0", "-i", "list.txt", "-i", str(Path(audio).resolve()),
+        "-map", "0:v:0", "-map", "1:a:0", *video_args,
+        *audio_codec_args(audio), "-shortest", "-movflags", "+faststart", str(Path(out_path).resolve()),
     ], cwd=tmp)
-    run_cmd([ffmpeg, "-y", "-i", str(concat_out), "-i", audio, "-c:v", "copy", "-c:a", "aac", "-shortest", out_path])
 
 
-def probe_video_meta(path: str):
+class VideoMeta(NamedTuple):
+    width: int
+    height: int
+    duration: float
+
+
+def probe_video_meta(path: str, persisted: Optional[dict] = None) -> VideoMeta:
+    """Probe size and duration of a video; each file version is probed once.
+
+    persisted, if given, is a JSON-able dict (a job's "probe_cache") consulted before ffprobe and filled after it;
+    it holds one [mtime_ns, size, *meta] entry per file name, so a re-upload replaces its old entry.
+    """
+    key = os.path.basename(path)
+    try:
+        st = os.stat(path)
+        mtime, version = st.st_mtime, [st.st_mtime_ns, st.st_size]
+    except OSError:
+        mtime, version = 0.0, None
+    entry = persisted.get(key) if persisted is not None else None
+    if version and entry and entry[:2] == version:
+        return VideoMeta(*entry[2:])
+    meta = _probe_video_meta_cached(path, mtime)
+    if persisted is not None and version and meta.duration > 0:  # don't pin a failed probe to the job
+        persisted[key] = version + list(meta)
+    return meta
+
+
+@functools.lru_cache(maxsize=128)
+def _probe_video_meta_cached(path: str, mtime: float) -> VideoMeta:
     ffprobe = _ffprobe_bin()
     try:
         proc = subprocess.run([
@@ -764,70 +1164,253 @@ def probe_video_meta(path: str):
             except Exception: pass
         if not w or not h: w, h = 1280, 720
         if dur is None: dur = 0.0
-        return w, h, float(dur)
+        return VideoMeta(w, h, float(dur))
+    except Exception:
+        return VideoMeta(1280, 720, 0.0)
+
+
+def audio_codec_args(path: str) -> List[str]:
+    """Audio codec flags for the final mux: AAC sources are copied, anything else is encoded to AAC."""
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        mtime = 0.0
+    return ["-c:a", "copy"] if _probe_audio_codec_cached(path, mtime) == "aac" else ["-c:a", "aac"]
+
+
+@functools.lru_cache(maxsize=128)
+def _probe_audio_codec_cached(path: str, mtime: float) -> str:
+    ffprobe = _ffprobe_bin()
+    try:
+        proc = subprocess.run([
+            ffprobe, "-v", "error", "-select_streams", "a:0",
+            "-show_entries", "stream=codec_name", "-of", "default=nw=1:nk=1", path,
+        ], check=True, capture_output=True, text=True)
+        return proc.stdout.strip()
     except Exception:
-        return 1280, 720, 0.0
+        return ""
+
+
+def _render_videos_graph(plan: List[Tuple[str, float, float, bool]], audio: str, fps: float, out_path: str, target_w: int, target_h: int) -> None:
+    """Cut, scale, concat and mux a segment plan in a single ffmpeg filter_complex pass."""
+    ffmpeg = _ffmpeg_bin()
+    sources = list(dict.fromkeys(src for src, _, _, _ in plan))
+    looped = {src for src, _, _, loop in plan if loop}
+
+    enc = _h264_encoder()
+    cmd = [ffmpeg, "-y", *FFMPEG_QUIET, *enc.input_args]
+    for src in sources:
+        if src in looped:
+            cmd += ["-stream_loop", "-1"]
+        cmd += ["-i", src]
+    cmd += ["-i", audio]
+
+    # each source is opened once, resampled and fitted, then split into one branch per segment that uses it;
+    # fitting before the split keeps the frames split queues for later branches at output size and rate
+    chains = []
+    vf = _fit_vf(fps, target_w, target_h) + ",setsar=1"
+    for n, src in enumerate(sources):
+        branches = [f"[c{k}]" for k, seg in enumerate(plan) if seg[0] == src]
+        chains.append(f"[{n}:v]{vf},split={len(branches)}{''.join(branches)}")
+    for k, (_, ss, length, _) in enumerate(plan):
+        chains.append(f"[c{k}]trim=start={ss:.3f}:duration={length:.3f},setpts=PTS-STARTPTS[v{k}]")
+    chains.append("".join(f"[v{k}]" for k in range(len(plan))) + f"concat=n={len(plan)}:v=1:a=0" + (f",{enc.upload_filter}" if enc.upload_filter else "") + "[outv]")
+
+    cmd += [
+        "-filter_complex", ";".join(chains),
+        # trim/setpts don't carry the fps filter's rate through to the encoder, so state it
+        "-map", "[outv]", "-map", f"{len(sources)}:a:0", "-r", str(int(fps)), *enc.output_args,
+        *audio_codec_args(audio), "-shortest", "-movflags", "+faststart", out_path,
+    ]
+    run_cmd(cmd)
 
 
-def render_from_videos(videos: List[str], starts: List[float], ends: List[float], audio: str, fps: float, out_path: str, clip_mode: str = "head", aspect_ratio: str = "16:9") -> None:
+def render_from_videos(videos: List[str], starts: List[float], ends: List[float], audio: str, fps: float, out_path: str, clip_mode: str = "head", aspect_ratio: str = "16:9", probe_cache: Optional[dict] = None) -> None:
     if not videos:
         raise RuntimeError("No video files provided")
     ffmpeg = _ffmpeg_bin()
     
     # Set dimensions based on aspect ratio
-    aspect_map = {
-        "16:9": (1280, 720),
-        "1:1": (720, 720),
-        "9:16": (720, 1280),
-        "4:3": (960, 720),
-    }
-    target_w, target_h = aspect_map.get(aspect_ratio, (1280, 720))
+    target_w, target_h = ASPECT_MAP.get(aspect_ratio, (1280, 720))
 
-    tmp = Path(out_path).parent / "_preconv"
-    tmp.mkdir(parents=True, exist_ok=True)
-    clip_paths: List[Path] = []
+    # one ffprobe per unique source rather than per segment
+    meta = {v: probe_video_meta(v, probe_cache) for v in set(videos)}
 
-    for i, (s, e) in enumerate(zip(starts, ends), 1):
+    # (src, ss, length, loop) per segment; sources shorter than the segment are looped from the start
+    plan: List[Tuple[str, float, float, bool]] = []
+    for i, (s, e) in enumerate(zip(starts, ends)):
         length = max(1.0 / fps, e - s)
-        src = videos[(i - 1) % len(videos)]
-        _, _, dur = probe_video_meta(src)
-        out_i = tmp / f"seg_{i:04d}.mp4"
+        src = videos[i % len(videos)]
+        dur = meta[src].duration
         if dur > 0 and length <= dur:
             ss = max(dur - length, 0.0) if clip_mode == "tail" else 0.0
+            plan.append((src, ss, length, False))
+        else:
+            plan.append((src, 0.0, length, True))
+
+    if sum(p[2] for p in plan) * fps <= GRAPH_MAX_FRAMES:
+        _render_videos_graph(plan, audio, fps, out_path, target_w, target_h)
+        return
+
+    tmp = Path(out_path).parent / "_preconv"
+    tmp.mkdir(parents=True, exist_ok=True)
+    enc = _h264_encoder()
+    seg_args = _encode_args(_fit_vf(fps, target_w, target_h))
+
+    # identical (source, in point, length) segments are encoded once and listed repeatedly in the concat
+    unique: Dict[Tuple[str, float, float, bool], Tuple[Path, Tuple[str, float, float, bool]]] = {}
+    clip_paths = []
+    for seg in plan:
+        key = (seg[0], round(seg[1], 3), round(seg[2], 3), seg[3])
+        if key not in unique:
+            unique[key] = (tmp / f"seg_{len(unique) + 1:04d}.mp4", seg)
+        clip_paths.append(unique[key][0])
+
+    def _segment_cmd(out_i: Path, seg: Tuple[str, float, float, bool]) -> List[str]:
+        src, ss, length, loop = seg
+        if not loop:
             cmd = [
-                ffmpeg, "-y", "-ss", f"{ss:.3f}", "-t", f"{length:.3f}", "-i", src,
-                "-vf", f"fps={int(fps)},scale={target_w}:{target_h}:force_original_aspect_ratio=decrease,pad={target_w}:{target_h}:(ow-iw)/2:(oh-ih)/2:black",
-                "-an", "-pix_fmt", "yuv420p", "-c:v", "libx264", "-preset", "veryfast", "-crf", "20",
+                ffmpeg, "-y", *FFMPEG_QUIET, *enc.input_args, "-ss", f"{ss:.3f}", "-t", f"{length:.3f}", "-i", src, "-an",
+                *seg_args,
+                "-threads", str(SEGMENT_THREADS),
                 str(out_i),
             ]
         else:
             cmd = [
-                ffmpeg, "-y", "-stream_loop", "-1", "-t", f"{length:.3f}", "-i", src,
-                "-vf", f"fps={int(fps)},scale={target_w}:{target_h}:force_original_aspect_ratio=decrease,pad={target_w}:{target_h}:(ow-iw)/2:(oh-ih)/2:black",
-                "-an", "-pix_fmt", "yuv420p", "-c:v", "libx264", "-preset", "veryfast", "-crf", "20",
+                ffmpeg, "-y", *FFMPEG_QUIET, *enc.input_args, "-stream_loop", "-1", "-t", f"{length:.3f}", "-i", src, "-an",
+                *seg_args,
+                "-threads", str(SEGMENT_THREADS),
                 str(out_i),
             ]
-        run_cmd(cmd)
-        clip_paths.append(out_i)
+        return cmd
+
+    # segments are independent encodes
+    cmds = [_segment_cmd(p, seg) for p, seg in unique.values()]
+    run_cmds(cmds, _segment_workers(len(cmds)))
 
-    # Concat (Windows-safe)
+    # Concat (Windows-safe) and mux the audio in the same pass
     list_file = tmp / "list.txt"
     list_text = "ffconcat version 1.0\n" + "\n".join(f"file '{p.name}'" for p in clip_paths) + "\n"
     list_file.write_text(list_text, encoding="utf-8", newline="\n")
-    concat_out = tmp / "video.mp4"
+    # every segment shares one encoder config and starts on a keyframe, so their bitstreams join as-is
     run_cmd([
-        ffmpeg, "-y", "-f", "concat", "-safe", "0", "-i", "list.txt",
-        "-fflags", "+genpts", "-r", str(int(fps)), "-pix_fmt", "yuv420p",
-        "-c:v", "libx264", "-preset", "veryfast", "-crf", "20", "-movflags", "+faststart", str(concat_out),
+        ffmpeg, "-y", *FFMPEG_QUIET, "-f", "concat", "-safe", "0", "-i", "list.txt", "-i", str(Path(audio).resolve()),
+        "-map", "0:v:0", "-map", "1:a:0", "-c:v", "copy", *audio_codec_args(audio), "-shortest", "-movflags", "+faststart",
+        str(Path(out_path).resolve()),
     ], cwd=tmp)
 
-    # Mux with audio
-    run_cmd([ffmpeg, "-y", "-i", str(concat_out), "-i", audio, "-c:v", "copy", "-c:a", "aac", "-shortest", out_path])
+# ---------------- analysis jobs ----------------
+
+ANALYSIS_JOBS: Dict[str, Future] = {}  # job_id -> pending analysis submitted by this web process
+_ANALYSIS_POOL: Optional[ProcessPoolExecutor] = None
+_ANALYSIS_POOL_LOCK = threading.Lock()  # request threads race to create (or replace) the pool
+
+def _warm_analysis() -> None:
+    """Pool initializer: run the analysis once on silence so numba compiles (or loads) its kernels before a real job."""
+    try:
+        env = _compute_env(np.zeros(ANALYSIS_SR, dtype=np.float32), ANALYSIS_SR)
+        _pick_onsets(env, ANALYSIS_SR)
+    except Exception as e:
+        print(f"Analysis warmup failed: {e}")
+
+def _new_analysis_pool() -> ProcessPoolExecutor:
+    # compiled numba kernels persist here, so restarts and new workers load them instead of recompiling
+    os.environ.setdefault("NUMBA_CACHE_DIR", str(ANALYSIS_CACHE_DIR / "numba"))
+    # spawn rather than fork: the web server is threaded
+    # each worker is already multithreaded (numba kernel + FFTs) and peaks near 0.8 GB, so keep the pool small
+    workers = int(os.environ.get("ANALYSIS_WORKERS", min(2, _cpu_count())))
+    # and split the cores between workers instead of giving each all of them; spawned workers inherit this
+    os.environ.setdefault("NUMBA_NUM_THREADS", str(max(1, _cpu_count() // workers)))
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"), initializer=_warm_analysis)
+    pool.submit(int)  # start a worker now so its warmup overlaps with the user picking a file
+    return pool
+
+def _analysis_pool(broken: Optional[ProcessPoolExecutor] = None) -> ProcessPoolExecutor:
+    """The process-wide analysis pool, created on first use; pass a pool that raised BrokenProcessPool to replace it."""
+    global _ANALYSIS_POOL
+    with _ANALYSIS_POOL_LOCK:
+        if _ANALYSIS_POOL is None or (broken is not None and _ANALYSIS_POOL is broken):
+            # only the thread that still sees the broken instance replaces it; later ones get the new pool
+            if _ANALYSIS_POOL is not None:
+                print("Analysis pool broken, restarting it")
+                _ANALYSIS_POOL.shutdown(wait=False)
+            _ANALYSIS_POOL = _new_analysis_pool()
+        return _ANALYSIS_POOL
+
+def _submit_analysis(*args) -> Future:
+    pool = _analysis_pool()
+    try:
+        return pool.submit(analyze_job, *args)
+    except BrokenProcessPool:
+        # a worker died (e.g. OOM-killed on a big upload) and the executor never recovers; start a fresh one
+        return _analysis_pool(broken=pool).submit(analyze_job, *args)
+
+def analyze_job(job_dir: str, audio_filename: Optional[str], video_filename: Optional[str] = None) -> None:
+    """Analyse an uploaded job in a worker process, leaving cuts.json, cuts.csv and waveform.png in job_dir."""
+    job_dir = Path(job_dir)
+
+    # Fixed values for simplified UX
+    fps = 30  # Default fixed at 30 FPS
+    threshold = 0.30
+    max_gap = 5.0
+    flash_start = 10.0
+    flash_end = 25.0
+    flash_gap = 0.12
+
+    samples = None
+    if video_filename:
+        # Extract the audio next to the video, named after it
+        extracted = extract_audio_from_video(job_dir / video_filename, job_dir / os.path.splitext(video_filename)[0], ANALYSIS_SR)
+        if extracted is None:
+            raise RuntimeError("could not extract audio from the video, please try a different file")
+        audio_path, samples = extracted
+        audio_filename = audio_path.name
+    audio_path = job_dir / audio_filename
+
+    # Analyze audio
+    events, duration, sr, y, env = detect_beats(str(audio_path), threshold=threshold, samples=samples)
+    starts, ends = compute_intervals(events, duration, fps, max_gap)
+
+    # Add flash times if needed
+    flash_times = detect_flash_window(env, sr, (flash_start, flash_end), flash_gap, fps, threshold) if flash_end > flash_start else []
+    if flash_times:
+        starts, ends = inject_flash_splits(starts, ends, flash_times, fps)
+
+    # Save data
+    data = {
+        "audio": audio_filename,
+        "fps": fps,
+        "max_gap": max_gap,
+        "duration": duration,
+        "events_onsets": events,
+        "segments": [{"start": s, "end": e} for s, e in zip(starts, ends)],
+        "flash": flash_times,
+        "flash_window": [flash_start, flash_end]
+    }
+
+    # Record the source of the audio (direct upload or extracted from video)
+    if video_filename:
+        data["audio_source"] = "extracted_from_video"
+        data["original_video"] = video_filename
+    else:
+        data["audio_source"] = "direct_upload"
+
+    _write_json(job_dir / "cuts.json", data)
+
+    # Create CSV file for download
+    (job_dir / "cuts.csv").write_text(
+        "index,start,end\n" + "\n".join("%d,%.3f,%.3f" % row for row in zip(range(1, len(starts) + 1), starts, ends)),
+        encoding="utf-8",
+    )
+
+    # Create waveform visualization
+    plot_waveform(job_dir / "waveform.png", y, duration, flash_times, (flash_start, flash_end))
 
 # ---------------- routes ----------------
 @app.route("/")
 def index():
-    return render_template_string(INDEX_HTML)
+    _analysis_pool()
+    return render_template(INDEX_TPL)
 
 @app.route("/upload-audio", methods=["POST"])
 def upload_audio():
@@ -838,93 +1421,53 @@ def upload_audio():
         if not video_file or video_file.filename == "":
             flash("Please upload either an audio file or a video to extract audio from.")
             return redirect(url_for("index"))
-    
-    # Fixed values for simplified UX
-    fps = 30  # Default fixed at 30 FPS
-    threshold = 0.30
-    max_gap = 5.0
-    flash_start = 10.0
-    flash_end = 25.0
-    flash_gap = 0.12
 
     # Create job directory
     job_id = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
     job_dir = JOBS_DIR / job_id
     job_dir.mkdir(parents=True, exist_ok=True)
 
-    # Process the uploaded files
+    # Save the upload; extraction and analysis happen in the worker pool
+    audio_filename = video_filename = None
     if audio_file and audio_file.filename != "":
-        # Save audio file directly
         audio_filename = audio_file.filename
-        audio_path = job_dir / audio_filename
-        audio_file.save(str(audio_path))
+        save_upload(audio_file, job_dir / audio_filename)
     else:
-        # Extract audio from video
         video_filename = video_file.filename
-        video_path = job_dir / video_filename
-        video_file.save(str(video_path))
-        
-        # Generate audio filename based on the video name
-        audio_filename = os.path.splitext(video_filename)[0] + ".mp3"
-        audio_path = job_dir / audio_filename
-        
-        # Extract the audio
-        if not extract_audio_from_video(video_path, audio_path):
-            flash("Failed to extract audio from the video. Please try a different file.")
-            return redirect(url_for("index"))
+        save_upload(video_file, job_dir / video_filename)
 
     try:
-        # Analyze audio
-        events, duration, sr, y = detect_beats(str(audio_path), threshold=threshold)
-        starts, ends = compute_intervals(events, duration, fps, max_gap)
-
-        # Add flash times if needed
-        flash_times = detect_flash_window(y, sr, (flash_start, flash_end), flash_gap, fps, threshold) if flash_end > flash_start else []
-        if flash_times:
-            starts, ends = inject_flash_splits(starts, ends, flash_times, fps)
-
-        # Save data
-        data = {
-            "audio": audio_filename,
-            "fps": fps,
-            "max_gap": max_gap,
-            "events_onsets": events,
-            "segments": [{"start": s, "end": e} for s, e in zip(starts, ends)],
-            "flash": flash_times,
-            "flash_window": [flash_start, flash_end]
-        }
-        (job_dir / "cuts.json").write_text(json.dumps(data, indent=2), encoding="utf-8")
-        
-        # Create CSV file for download
-        (job_dir / "cuts.csv").write_text(
-            "index,start,end\n" + "\n".join(f"{i+1},{s:.3f},{e:.3f}" for i, (s, e) in enumerate(zip(starts, ends))),
-            encoding="utf-8",
-        )
-        
-        # Create waveform visualization
-        plot_waveform(job_dir / "waveform.png", y, sr, flash_times, (flash_start, flash_end))
-        
-        # Record the source of the audio (direct upload or extracted from video)
-        if video_file and video_file.filename != "":
-            data["audio_source"] = "extracted_from_video"
-            data["original_video"] = video_filename
-        else:
-            data["audio_source"] = "direct_upload"
-        
-        (job_dir / "cuts.json").write_text(json.dumps(data, indent=2), encoding="utf-8")
-        
-        # Redirect to analysis results page
-        return render_template_string(
-            ANALYSIS_RESULT_HTML,
-            job_id=job_id,
-            audio_filename=audio_filename,
-            duration=round(duration, 1),
-            num_segments=len(starts),
-            audio_source="Video" if video_file and video_file.filename != "" else "Audio Upload"
-        )
+        ANALYSIS_JOBS[job_id] = _submit_analysis(str(job_dir), audio_filename, video_filename)
     except Exception as e:
-        flash(f"Failed to analyze audio: {str(e)}")
+        flash(f"Failed to start audio analysis: {e}")
         return redirect(url_for("index"))
+    return redirect(url_for("analysis_status", job_id=job_id))
+
+@app.route("/analysis/<job_id>", methods=["GET"])
+def analysis_status(job_id):
+    job_dir = JOBS_DIR / job_id
+    future = ANALYSIS_JOBS.get(job_id)
+    if future is not None:
+        if not future.done():
+            return render_template(ANALYSIS_PENDING_TPL, job_id=job_id)
+        ANALYSIS_JOBS.pop(job_id, None)
+        if future.exception() is not None:
+            flash(f"Failed to analyze audio: {future.exception()}")
+            return redirect(url_for("index"))
+
+    if not job_dir.exists() or not (job_dir / "cuts.json").exists():
+        flash("Invalid job ID or session expired.")
+        return redirect(url_for("index"))
+
+    data = json.loads((job_dir / "cuts.json").read_text(encoding="utf-8"))
+    return render_template(
+        ANALYSIS_RESULT_TPL,
+        job_id=job_id,
+        audio_filename=data["audio"],
+        duration=round(data.get("duration", 0.0), 1),
+        num_segments=len(data["segments"]),
+        audio_source="Video" if data.get("audio_source") == "extracted_from_video" else "Audio Upload"
+    )
 
 @app.route("/upload-media/<job_id>", methods=["GET"])
 def upload_media_page(job_id):
@@ -939,8 +1482,8 @@ def upload_media_page(job_id):
     audio_filename = data["audio"]
     num_segments = len(data["segments"])
     
-    return render_template_string(
-        UPLOAD_VISUAL_HTML,
+    return render_template(
+        UPLOAD_VISUAL_TPL,
         job_id=job_id,
         audio_filename=audio_filename,
         num_segments=num_segments
@@ -969,15 +1512,15 @@ def preview_media(job_id):
     for f in request.files.getlist("videos"):
         if f and f.filename:
             dst = job_dir / f.filename
-            f.save(str(dst))
+            save_upload(f, dst)
             media_files.append({"type": "video", "filename": f.filename})
     
     # Process images
     for f in request.files.getlist("images"):
         if f and f.filename.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp')):
             dst = job_dir / f.filename
-            f.save(str(dst))
-            media_files.append({"type": "image", "filename": f.filename})
+            save_upload(f, dst)
+            media_files.append({"type": "image", "filename": f.filename, "thumb": make_thumbnail(dst)})
     
     if not media_files:
         flash("Please upload at least one video clip or PNG image.")
@@ -986,10 +1529,10 @@ def preview_media(job_id):
     # Save media info and aspect ratio to job
     data["media_files"] = media_files
     data["aspect_ratio"] = aspect_ratio
-    (job_dir / "cuts.json").write_text(json.dumps(data, indent=2), encoding="utf-8")
+    _write_json(job_dir / "cuts.json", data)
     
-    return render_template_string(
-        RENDER_OPTIONS_HTML,
+    return render_template(
+        RENDER_OPTIONS_TPL,
         job_id=job_id,
         audio_filename=audio_filename,
         num_segments=num_segments,
@@ -1029,11 +1572,16 @@ def render_video(job_id):
     
     if saved_videos:
         out_path = job_dir / output_name
+        # ffprobe results are kept with the job, so re-renders (even after a restart) skip probing
+        probe_cache = data.setdefault("probe_cache", {})
+        probed = dict(probe_cache)
         try:
-            render_from_videos(saved_videos, starts, ends, str(audio_path), fps, str(out_path), clip_mode=clip_mode, aspect_ratio=aspect_ratio)
+            render_from_videos(saved_videos, starts, ends, str(audio_path), fps, str(out_path), clip_mode=clip_mode, aspect_ratio=aspect_ratio, probe_cache=probe_cache)
             rendered = True
         except Exception as e:
             flash(f"FFmpeg video render failed: {str(e)}")
+        if probe_cache != probed:
+            _write_json(job_dir / "cuts.json", data)
     else:
         # Try PNG fallback
         pngs = [str(job_dir / item["filename"]) for item in media_files if item["type"] == "image"]
@@ -1050,8 +1598,8 @@ def render_video(job_id):
             return redirect(url_for("upload_media_page", job_id=job_id))
 
     # Show the final result
-    return render_template_string(
-        RESULT_HTML,
+    return render_template(
+        RESULT_TPL,
         job_id=job_id,
         fps=fps,
         num_onsets=len(data["events_onsets"]),
@@ -1068,46 +1616,57 @@ def download(job_id, filename):
     folder = JOBS_DIR / job_id
     if not folder.exists():
         return "Not found", 404
-    return send_from_directory(folder, filename, as_attachment=True)
+    # ETag/If-None-Match handling is on by default; files that never change also get a long max-age
+    max_age = 31536000 if filename in IMMUTABLE_JOB_FILES else None
+    return send_from_directory(folder, filename, as_attachment=True, max_age=max_age)
 
 def inject_flash_splits(starts: List[float], ends: List[float], flash_times: List[float], fps: float):
     if not flash_times:
         return starts, ends
-    flash = sorted(quantize_to_fps(flash_times, fps))
-    out_s, out_e = [], []
-    for s, e in zip(starts, ends):
-        cuts = [t for t in flash if s < t < e]
-        if not cuts:
-            out_s.append(s)
-            out_e.append(e)
-            continue
-        pts = [s] + cuts + [e]
-        for i in range(len(pts) - 1):
-            a, b = pts[i], pts[i + 1]
-            if b - a < 1.0 / fps:
-                b = a + 1.0 / fps
-            out_s.append(round(a, 3))
-            out_e.append(round(b, 3))
-    return out_s, out_e
-
-
-def plot_waveform(png_path: Path, y: np.ndarray, sr: int, flash_times: List[float], window: Tuple[float, float]):
-    t = np.linspace(0, librosa.get_duration(y=y, sr=sr), num=len(y), endpoint=True)
-    plt.figure(figsize=(18, 4))
-    plt.fill_between(t, y, -y, color="#f0b429", alpha=0.25)
-    plt.plot(t, y, color="#f0b429", lw=0.7, alpha=0.8)
+    flash = np.sort(quantize_to_fps(flash_times, fps))
+    s, e = np.asarray(starts, dtype=np.float64), np.asarray(ends, dtype=np.float64)
+    # flash[lo[i]:hi[i]] are the cuts strictly inside segment i; a segment with n cuts becomes n + 1 pieces
+    lo = np.searchsorted(flash, s, side="right")
+    hi = np.maximum(np.searchsorted(flash, e, side="left"), lo)
+    pieces = hi - lo + 1
+    seg = np.repeat(np.arange(len(s)), pieces)
+    k = np.arange(pieces.sum()) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+    cut = lo[seg] + k  # flash index ending piece k; clipped where the segment's own start/end is used instead
+    a = np.where(k == 0, s[seg], flash[np.clip(cut - 1, 0, len(flash) - 1)])
+    b = np.where(k == pieces[seg] - 1, e[seg], flash[np.clip(cut, 0, len(flash) - 1)])
+    # segments without cuts pass through untouched; split pieces last at least a frame and are rounded to ms
+    split = pieces[seg] > 1
+    b = np.where(split & (b - a < 1.0 / fps), a + 1.0 / fps, b)
+    return np.where(split, np.round(a, 3), a).tolist(), np.where(split, np.round(b, 3), b).tolist()
+
+
+def plot_waveform(png_path: Path, y: np.ndarray, duration: float, flash_times: List[float], window: Tuple[float, float]):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from PIL import Image
+    # min/max per bin: a few thousand points instead of one per sample
+    step = max(1, len(y) // WAVEFORM_BINS)
+    bins = y[: (len(y) // step) * step].reshape(-1, step)
+    t = np.linspace(0, duration, num=len(bins), endpoint=True)
+    # plain Figure + Agg canvas: nothing is registered with pyplot, so nothing lingers per request;
+    # fixed margins (what tight_layout picks for this size) skip its extra text-measuring pass
+    fig = Figure(figsize=(12, 3), dpi=100)
+    fig.subplots_adjust(left=0.08, right=0.985, bottom=0.2, top=0.88)
+    ax = fig.subplots()
+    ax.fill_between(t, bins.min(axis=1), bins.max(axis=1), color="#f0b429", alpha=0.8, lw=0)
     lo, hi = min(window), max(window)
-    plt.axvline(lo, color="red", ls="--", lw=2, dashes=(6, 6))
-    plt.axvline(hi, color="red", ls="--", lw=2, dashes=(6, 6))
+    ax.axvline(lo, color="red", ls="--", lw=2, dashes=(6, 6))
+    ax.axvline(hi, color="red", ls="--", lw=2, dashes=(6, 6))
     for x in flash_times:
-        plt.axvline(x, color="#22c55e", ls=(0, (3, 5)), lw=1.4, alpha=0.9)
-    plt.title("Waveform with Flash Cut Points")
-    plt.xlabel("Time (s)")
-    plt.ylabel("Amplitude")
-    plt.grid(True, alpha=0.25, ls="--")
-    plt.tight_layout()
-    plt.savefig(png_path, dpi=150)
-    plt.close()
+        ax.axvline(x, color="#22c55e", ls=(0, (3, 5)), lw=1.4, alpha=0.9)
+    ax.set_title("Waveform with Flash Cut Points")
+    ax.set_xlabel("Time (s)")
+    ax.set_ylabel("Amplitude")
+    ax.grid(True, alpha=0.25, ls="--")
+    canvas = FigureCanvasAgg(fig)
+    canvas.draw()
+    # encode the RGBA buffer directly; fast zlib level, the plot is mostly flat colour
+    Image.frombuffer("RGBA", canvas.get_width_height(), canvas.buffer_rgba(), "raw", "RGBA", 0, 1).save(png_path, "PNG", compress_level=1)
 
 # --- keep everything above as-is ---
 
@@ -1131,6 +1690,10 @@ def ffmpeg_check():
         "environment": dict(os.environ),
         "path": os.environ.get("PATH", ""),
         "cwd": os.getcwd(),
+        "h264_encoder": _h264_encoder().name,
+        "ffmpeg_major": _ffmpeg_major(),
+        # below this, image renders fall back to encoding each segment separately
+        "single_pass_images": _ffmpeg_major() >= FFCONCAT_OPTION_MIN,
         "timestamp": datetime.now().isoformat()
     }
     
@@ -1155,8 +1718,6 @@ def ffmpeg_check():
 
 if __name__ == "__main__":
     import os
-    import matplotlib
-    matplotlib.use("Agg")  # headless on Railway
     
     # Print diagnostic info at startup
     ffmpeg = _ffmpeg_bin()
@@ -1177,5 +1738,6 @@ if __name__ == "__main__":
         print(f"Failed to run FFmpeg: {str(e)}")
     
     port = int(os.environ.get("PORT", "8080"))
-    app.run(host="0.0.0.0", port=port)
+    # one thread per request, like the gthread worker in the Procfile; analysis runs in the process pool either way
+    app.run(host="0.0.0.0", port=port, threaded=True)
 